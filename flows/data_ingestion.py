@@ -1,183 +1,214 @@
-from prefect import flow, task
-from sqlalchemy import create_engine, select, and_, or_
+from prefect import flow, task, unmapped
+from prefect.futures import PrefectFuture, wait
+from sqlalchemy import DateTime, Float, Integer, String, UniqueConstraint
 from sqlalchemy.orm import Session
 import pandas as pd
-from typing import List, Dict, Any
+from typing import Iterator, List, Dict, Tuple
 import logging
 from models.tables import Order, Inventory
-from sqlalchemy.dialects.postgresql import insert
-from .utils import no_cache_key, camel_to_snake
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+from .utils import no_cache_key, get_engine, camel_to_snake
+
+CSV_CHUNKSIZE = 50_000
+UPSERT_BATCH_SIZE = 5000
+UPSERT_CONCURRENCY = 4
+
+
+def csv_read_options(file_path: str, model) -> Dict:
+    """Build read_csv names, usecols and dtypes from the header and model"""
+    table_columns = {
+        column.name: column
+        for column in model.__table__.columns
+        if not column.primary_key
+    }
+    names = [
+        camel_to_snake(csv_column)
+        for csv_column in pd.read_csv(file_path, nrows=0).columns
+    ]
+
+    usecols = []
+    dtype = {}
+    parse_dates = []
+    for name in names:
+        column = table_columns.get(name)
+        if column is None:
+            continue
+
+        usecols.append(name)
+        if isinstance(column.type, DateTime):
+            parse_dates.append(name)
+        elif isinstance(column.type, String):
+            dtype[name] = str
+        elif isinstance(column.type, Integer):
+            dtype[name] = 'Int32'
+        elif isinstance(column.type, Float):
+            dtype[name] = 'float64'
+
+    return {
+        'names': names,
+        'header': 0,
+        'usecols': usecols,
+        'dtype': dtype,
+        'parse_dates': parse_dates,
+        'date_format': 'ISO8601'
+    }
+
+
+def upsert_key(model) -> List[str]:
+    """Columns of the model's unique constraint that upserts conflict on"""
+    return next(
+        list(constraint.columns.keys())
+        for constraint in model.__table__.constraints
+        if isinstance(constraint, UniqueConstraint)
+    )
+
+
+def read_csv_chunks(
+    file_path: str,
+    model,
+    chunksize: int
+) -> Iterator[pd.DataFrame]:
+    """Read a CSV file for a model in chunks, with NULLs as None"""
+    key = upsert_key(model)
+    for df in pd.read_csv(
+        file_path,
+        chunksize=chunksize,
+        **csv_read_options(file_path, model)
+    ):
+        # Postgres treats NULLs as distinct, so rows missing part of the
+        # upsert key could never be matched and are skipped instead
+        missing_key = df[key].isna().any(axis=1)
+        if missing_key.any():
+            logging.warning(
+                f"Skipping {missing_key.sum()} {model.__tablename__} rows "
+                f"with an empty {', '.join(key)}"
+            )
+            df = df[~missing_key]
 
-
-def get_existing_inventories(
-    engine,
-    product_ids: List[str]
-) -> Dict[str, Dict[str, Any]]:
-    """Get existing inventory items by product_id"""
-    with Session(engine) as session:
-        query = session.execute(
-            select(Inventory).where(Inventory.product_id.in_(product_ids))
-        ).scalars().all()
-
-        return {
-            inventory.product_id: {
-                'id': inventory.id,
-                'product_id': inventory.product_id,
-                'name': inventory.name,
-                'quantity': inventory.quantity,
-                'category': inventory.category,
-                'sub_category': inventory.sub_category
-            }
-            for inventory in query
-        }
-
-
-def get_existing_orders(
-    engine,
-    order_product_pairs: List[tuple]
-) -> Dict[tuple, Dict[str, Any]]:
-    """Get existing orders by a combination of order_id and product_id"""
-    with Session(engine) as session:
-        conditions = [
-            and_(Order.order_id == order_id, Order.product_id == product_id)
-            for order_id, product_id in order_product_pairs
-        ]
-
-        query = session.execute(
-            select(Order).where(or_(*conditions))
-        ).scalars().all()
-
-        return {
-            (order.order_id, order.product_id): {
-                'id': order.id,
-                'order_id': order.order_id,
-                'product_id': order.product_id,
-                'currency': order.currency,
-                'quantity': order.quantity,
-                'shipping_cost': order.shipping_cost,
-                'amount': order.amount,
-                'channel': order.channel,
-                'channel_group': order.channel_group,
-                'campaign': order.campaign,
-                'date_time': order.date_time
-            }
-            for order in query
-        }
+        yield df.astype(object).where(df.notna(), None)
 
 
-@task(name="Read Inventories CSV", retries=2)
-def read_inventories_csv(file_path: str) -> pd.DataFrame:
-    """Read inventory data from CSV file and perform initial data cleaning"""
-    df = pd.read_csv(file_path)
-    df.columns = [camel_to_snake(col) for col in df.columns]
+def rows_for_upsert(df: pd.DataFrame) -> Tuple[List[str], List[tuple]]:
+    """Convert a DataFrame into column names and row tuples for upsert"""
+    columns = df.columns.tolist()
+    return columns, list(zip(*(df[column].tolist() for column in columns)))
 
-    if 'product_id' in df.columns:
-        df['product_id'] = df['product_id'].astype(str)
 
-    return df
+@task(name="Read Inventories CSV", retries=2)
+def read_inventories_csv(
+    file_path: str,
+    chunksize: int = CSV_CHUNKSIZE
+) -> Iterator[pd.DataFrame]:
+    """Read inventory data from CSV file in chunks"""
+    yield from read_csv_chunks(file_path, Inventory, chunksize)
 
 
 @task(name="Read Orders CSV", retries=2)
-def read_orders_csv(file_path: str) -> pd.DataFrame:
-    """Read orders from CSV file and perform initial data cleaning"""
-    df = pd.read_csv(file_path)
-    df.columns = [camel_to_snake(col) for col in df.columns]
-
-    date_columns = ['date_time']
-    for col in date_columns:
-        if col in df.columns:
-            df[col] = pd.to_datetime(
-                df[col].str.replace("Z", "+00:00"), format='ISO8601'
-            )
-
-    if 'product_id' in df.columns:
-        df['product_id'] = df['product_id'].astype(str)
-
-    return df
+def read_orders_csv(
+    file_path: str,
+    chunksize: int = CSV_CHUNKSIZE
+) -> Iterator[pd.DataFrame]:
+    """Read orders from CSV file in chunks"""
+    yield from read_csv_chunks(file_path, Order, chunksize)
 
 
 @task(name="Prepare Inventories for Upsert")
 def prepare_inventories_for_upsert(
-    df: pd.DataFrame,
-    existing_inventories: Dict[str, Dict[str, Any]]
-) -> tuple[List[Dict], List[Dict]]:
-    """Separate inventories into updates and inserts"""
-    updates = []
-    inserts = []
+    df: pd.DataFrame
+) -> Tuple[List[str], List[tuple]]:
+    """Convert inventories into column names and row tuples for upsert"""
+    return rows_for_upsert(df)
 
-    for _, row in df.iterrows():
-        inventory_data = {
-            key: (None if pd.isna(value) else value)
-            for key, value in row.to_dict().items()
-        }
 
-        product_id = str(inventory_data['product_id'])
-
-        if product_id in existing_inventories:
-            updates.append({
-                'id': existing_inventories[product_id]['id'],
-                **inventory_data
-            })
-        else:
-            inserts.append(inventory_data)
+@task(name="Prepare Orders for Upsert")
+def prepare_orders_for_upsert(
+    df: pd.DataFrame
+) -> Tuple[List[str], List[tuple]]:
+    """Convert orders into column names and row tuples for upsert"""
+    return rows_for_upsert(df)
+
+
+def upsert_rows(
+    session: Session,
+    model,
+    columns: List[str],
+    rows: List[tuple],
+    index_elements: List[str]
+) -> None:
+    """Upsert rows in pages with psycopg2 execute_values and ON CONFLICT"""
+    # Postgres refuses to touch the same row twice in one statement,
+    # so duplicate keys are collapsed with the last occurrence winning
+    key_positions = [columns.index(column) for column in index_elements]
+    rows_by_key = {
+        tuple(row[position] for position in key_positions): row
+        for row in rows
+    }
+
+    # Chunks are upserted in concurrent transactions; writing keys in
+    # sorted order gives them all the same lock order, so overlapping
+    # chunks wait on each other instead of deadlocking. Which of two
+    # overlapping chunks commits last (and so wins) is still a race.
+    rows = [rows_by_key[key] for key in sorted(rows_by_key)]
+
+    if not rows:
+        return
+
+    table = sql.Identifier(model.__tablename__)
+    value_columns = [
+        sql.Identifier(column)
+        for column in columns
+        if column not in index_elements
+    ]
+    # Unchanged rows are skipped so re-ingesting a file does not rewrite
+    # every existing row
+    query = sql.SQL(
+        "INSERT INTO {table} ({columns}) VALUES %s "
+        "ON CONFLICT ({keys}) DO UPDATE SET {updates} "
+        "WHERE ({current}) IS DISTINCT FROM ({excluded})"
+    ).format(
+        table=table,
+        columns=sql.SQL(', ').join(map(sql.Identifier, columns)),
+        keys=sql.SQL(', ').join(map(sql.Identifier, index_elements)),
+        updates=sql.SQL(', ').join(
+            sql.SQL("{0} = EXCLUDED.{0}").format(column)
+            for column in value_columns
+        ),
+        current=sql.SQL(', ').join(
+            sql.SQL("{0}.{1}").format(table, column)
+            for column in value_columns
+        ),
+        excluded=sql.SQL(', ').join(
+            sql.SQL("EXCLUDED.{0}").format(column)
+            for column in value_columns
+        )
+    )
 
-    return updates, inserts
+    with session.connection().connection.cursor() as cursor:
+        execute_values(cursor, query, rows, page_size=UPSERT_BATCH_SIZE)
 
 
-@task(name="Prepare Orders for Upsert")
-def prepare_orders_for_upsert(
-    df: pd.DataFrame,
-    existing_orders: Dict[tuple, Dict[str, Any]]
-) -> tuple[List[Dict], List[Dict]]:
-    """Separate orders into updates and inserts"""
-    updates = []
-    inserts = []
-
-    for _, row in df.iterrows():
-        order_data = {
-            key: (None if pd.isna(value) else value)
-            for key, value in row.to_dict().items()
-        }
-
-        order_id = str(order_data['order_id'])
-        product_id = str(order_data['product_id'])
-        order_key = (order_id, product_id)
-
-        if order_key in existing_orders:
-            updates.append({
-                'id': existing_orders[order_key]['id'],
-                **order_data
-            })
-        else:
-            inserts.append(order_data)
-
-    return updates, inserts
-
-
-@task(name="Upsert Inventories", cache_key_fn=no_cache_key)
+@task(
+    name="Upsert Inventories",
+    cache_key_fn=no_cache_key,
+    retries=3,
+    retry_delay_seconds=5
+)
 def upsert_inventories(
     engine,
-    updates: List[Dict],
-    inserts: List[Dict]
+    columns: List[str],
+    rows: List[tuple]
 ) -> None:
     """Update existing inventories and insert new ones"""
     with Session(engine) as session:
         try:
-            for update_data in updates:
-                inventory_id = update_data.pop('id')
-                stmt = (
-                    select(Inventory)
-                    .where(Inventory.id == inventory_id)
-                )
-                inventory = session.execute(stmt).scalar_one()
-
-                for key, value in update_data.items():
-                    setattr(inventory, key, value)
-
-            for insert_data in inserts:
-                stmt = insert(Inventory).values(insert_data)
-                session.execute(stmt)
-
+            upsert_rows(
+                session,
+                Inventory,
+                columns,
+                rows,
+                upsert_key(Inventory)
+            )
             session.commit()
 
         except Exception as e:
@@ -185,30 +216,27 @@ def upsert_inventories(
             raise e
 
 
-@task(name="Upsert Orders", cache_key_fn=no_cache_key)
+@task(
+    name="Upsert Orders",
+    cache_key_fn=no_cache_key,
+    retries=3,
+    retry_delay_seconds=5
+)
 def upsert_orders(
     engine,
-    updates: List[Dict],
-    inserts: List[Dict]
+    columns: List[str],
+    rows: List[tuple]
 ) -> None:
     """Update existing orders and insert new ones"""
     with Session(engine) as session:
         try:
-            for update_data in updates:
-                order_id = update_data.pop('id')
-                stmt = (
-                    select(Order)
-                    .where(Order.id == order_id)
-                )
-                order = session.execute(stmt).scalar_one()
-
-                for key, value in update_data.items():
-                    setattr(order, key, value)
-
-            for insert_data in inserts:
-                stmt = insert(Order).values(insert_data)
-                session.execute(stmt)
-
+            upsert_rows(
+                session,
+                Order,
+                columns,
+                rows,
+                upsert_key(Order)
+            )
             session.commit()
 
         except Exception as e:
@@ -216,64 +244,115 @@ def upsert_orders(
             raise e
 
 
-@flow(name="Data Ingestion")
-def ingest_data(
-    orders_file_path: str,
-    inventories_file_path: str,
-    database_url: str,
-    db_name: str = "data_app"
-) -> None:
-    """Main flow for ingesting orders and inventories data"""
+def wait_for_futures(futures: List[PrefectFuture]) -> None:
+    """Wait for futures and re-raise the first failure"""
+    wait(futures)
+    for future in futures:
+        future.result()
 
-    engine = create_engine(f"{database_url}/{db_name}")
 
-    try:
-        df_orders = read_orders_csv(orders_file_path)
+def map_upserts(
+    upsert_task,
+    engine,
+    columns_chunks: List[List[str]],
+    rows_chunks: List[List[tuple]],
+    previous_futures: List[PrefectFuture]
+) -> List[PrefectFuture]:
+    """Map an upsert task over a window of chunks once the last one is done"""
+    wait_for_futures(previous_futures)
+    if not rows_chunks:
+        return []
+
+    return upsert_task.map(unmapped(engine), columns_chunks, rows_chunks)
+
+
+@task(name="Ingest Orders", cache_key_fn=no_cache_key)
+def ingest_orders(engine, file_path: str) -> None:
+    """Read, prepare and upsert orders, committing chunks concurrently"""
+    futures = []
+    columns_chunks, rows_chunks = [], []
+    for df_orders in read_orders_csv(file_path):
         logging.info(f"Read {len(df_orders)} rows from orders CSV")
 
-        order_product_pairs = [
-            (str(row['order_id']), str(row['product_id']))
-            for _, row in df_orders.iterrows()
-        ]
-        existing_orders = get_existing_orders(engine, order_product_pairs)
+        columns, rows_orders = prepare_orders_for_upsert(df_orders)
+        logging.info(f"Prepared {len(rows_orders)} rows for orders upsert")
+        columns_chunks.append(columns)
+        rows_chunks.append(rows_orders)
+
+        # The mapped window commits while the next one is read; waiting
+        # on it before mapping again keeps memory O(chunksize)
+        if len(rows_chunks) == UPSERT_CONCURRENCY:
+            futures = map_upserts(
+                upsert_orders,
+                engine,
+                columns_chunks,
+                rows_chunks,
+                futures
+            )
+            columns_chunks, rows_chunks = [], []
+
+    wait_for_futures(map_upserts(
+        upsert_orders,
+        engine,
+        columns_chunks,
+        rows_chunks,
+        futures
+    ))
+
+
+@task(name="Ingest Inventories", cache_key_fn=no_cache_key)
+def ingest_inventories(engine, file_path: str) -> None:
+    """Read, prepare and upsert inventories, committing chunks concurrently"""
+    futures = []
+    columns_chunks, rows_chunks = [], []
+    for df_inventories in read_inventories_csv(file_path):
+        logging.info(f"Read {len(df_inventories)} rows from inventories CSV")
 
-        updates_orders, inserts_orders = prepare_orders_for_upsert(
-            df_orders,
-            existing_orders
+        columns, rows_inventories = prepare_inventories_for_upsert(
+            df_inventories
         )
         logging.info(
-            f"Prepared {len(updates_orders)} updates and "
-            f"{len(inserts_orders)} inserts for orders"
+            f"Prepared {len(rows_inventories)} rows for inventories upsert"
         )
-        upsert_orders(engine, updates_orders, inserts_orders)
+        columns_chunks.append(columns)
+        rows_chunks.append(rows_inventories)
+
+        if len(rows_chunks) == UPSERT_CONCURRENCY:
+            futures = map_upserts(
+                upsert_inventories,
+                engine,
+                columns_chunks,
+                rows_chunks,
+                futures
+            )
+            columns_chunks, rows_chunks = [], []
 
-        df_inventories = read_inventories_csv(inventories_file_path)
-        logging.info(f"Read {len(df_inventories)} rows from inventories CSV")
+    wait_for_futures(map_upserts(
+        upsert_inventories,
+        engine,
+        columns_chunks,
+        rows_chunks,
+        futures
+    ))
 
-        inventory_product_ids = [
-            str(row['product_id']) for _, row in df_inventories.iterrows()
-        ]
-        existing_inventories = get_existing_inventories(
-            engine,
-            inventory_product_ids
-        )
 
-        updates_inventories, inserts_inventories = (
-            prepare_inventories_for_upsert(
-                df_inventories,
-                existing_inventories
-            )
-        )
+@flow(name="Data Ingestion")
+def ingest_data(
+    orders_file_path: str,
+    inventories_file_path: str,
+    database_url: str,
+    db_name: str = "data_app"
+) -> None:
+    """Main flow for ingesting orders and inventories data"""
 
-        logging.info(
-            f"Prepared {len(updates_inventories)} updates and "
-            f"{len(inserts_inventories)} inserts for inventories"
-        )
-        upsert_inventories(engine, updates_inventories, inserts_inventories)
+    engine = get_engine(f"{database_url}/{db_name}")
 
-        logging.info(
-            "Successfully completed data ingestion for orders and inventories"
-        )
+    # Orders and inventories touch disjoint tables, so both run at once
+    wait_for_futures([
+        ingest_orders.submit(engine, orders_file_path),
+        ingest_inventories.submit(engine, inventories_file_path)
+    ])
 
-    finally:
-        engine.dispose()
+    logging.info(
+        "Successfully completed data ingestion for orders and inventories"
+    )
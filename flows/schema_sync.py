@@ -1,10 +1,15 @@
 from prefect import flow, task
-from sqlalchemy import create_engine, text, inspect
-from typing import Dict, Optional, Type
+from sqlalchemy import create_engine, text, inspect, UniqueConstraint
+from sqlalchemy.pool import NullPool
+from sqlalchemy.schema import AddConstraint
+from typing import Dict, List, Optional, Set, Type
 import logging
-from models.tables import Base
-from .utils import no_cache_key
+from models.tables import Base, TABLES
+from .utils import no_cache_key, get_engine, SQL_ECHO
 import os
+import re
+
+DATABASE_NAME_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
 
 
 @task(name="Create Database Engine", retries=3, retry_delay_seconds=5)
@@ -23,11 +28,11 @@ def create_engine_task(
         SQLAlchemy engine instance
     """
     if database_name:
-        full_url = f"{database_url}/{database_name}"
-    else:
-        full_url = database_url
+        return get_engine(f"{database_url}/{database_name}")
 
-    return create_engine(full_url, echo=True)
+    # The maintenance database is only needed to create the app database,
+    # so its connections are closed on release instead of being pooled
+    return create_engine(database_url, echo=SQL_ECHO, poolclass=NullPool)
 
 
 @task(name="Check Database Exists", retries=2)
@@ -45,7 +50,8 @@ def check_database_exists(engine: create_engine, db_name: str) -> bool:
     try:
         with engine.connect() as connection:
             result = connection.execute(
-                text(f"SELECT 1 FROM pg_database WHERE datname = '{db_name}'")
+                text("SELECT 1 FROM pg_database WHERE datname = :db_name"),
+                {"db_name": db_name}
             ).fetchone()
             return bool(result)
     except Exception as e:
@@ -63,15 +69,23 @@ def create_database(engine: create_engine, db_name: str) -> None:
         db_name: Name of database to create
     """
     try:
+        # CREATE DATABASE cannot take bound parameters, so the name is
+        # validated and quoted as an identifier instead
+        if not DATABASE_NAME_RE.match(db_name):
+            raise ValueError(f"Invalid database name: {db_name!r}")
+
         with engine.connect() as connection:
-            connection.execute(text(f"""
+            connection.execute(text("""
                 SELECT pg_terminate_backend(pid)
                 FROM pg_stat_activity
-                WHERE datname = '{db_name}'
+                WHERE datname = :db_name
                 AND pid <> pg_backend_pid()
-            """))
+            """), {"db_name": db_name})
             connection.execute(text("commit"))
-            connection.execute(text(f"CREATE DATABASE {db_name}"))
+            quoted_db_name = connection.dialect.identifier_preparer.quote(
+                db_name
+            )
+            connection.execute(text(f"CREATE DATABASE {quoted_db_name}"))
             logging.info(f"Created database {db_name}")
     except Exception as e:
         logging.error(f"Error creating database: {e}")
@@ -79,24 +93,53 @@ def create_database(engine: create_engine, db_name: str) -> None:
 
 
 @task(name="Get Table Columns", cache_key_fn=no_cache_key)
-def get_existing_columns(engine: create_engine, table_name: str) -> Dict:
+def get_existing_columns(
+    engine: create_engine,
+    table_names: List[str]
+) -> Dict[str, Dict]:
+    """
+    Get existing columns for tables in a single reflection pass
+
+    Args:
+        engine: SQLAlchemy engine
+        table_names: Names of tables to inspect
+
+    Returns:
+        Dict of column information per existing table
+    """
+    columns_by_table = inspect(engine).get_multi_columns(
+        filter_names=table_names
+    )
+    return {
+        table_name: {column['name']: column for column in columns}
+        for (_, table_name), columns in columns_by_table.items()
+    }
+
+
+@task(name="Get Table Unique Constraints", cache_key_fn=no_cache_key)
+def get_existing_unique_constraints(
+    engine: create_engine,
+    table_names: List[str]
+) -> Dict[str, Set[tuple]]:
     """
-    Get existing columns for a table
+    Get existing unique constraints for tables in a single reflection pass
 
     Args:
         engine: SQLAlchemy engine
-        table_name: Name of table to inspect
+        table_names: Names of tables to inspect
 
     Returns:
-        Dict of column information
+        Dict of constrained column name tuples per existing table
     """
-    inspector = inspect(engine)
-    if inspector.has_table(table_name):
-        return {
-            column['name']: column
-            for column in inspector.get_columns(table_name)
+    constraints_by_table = inspect(engine).get_multi_unique_constraints(
+        filter_names=table_names
+    )
+    return {
+        table_name: {
+            tuple(constraint['column_names']) for constraint in constraints
         }
-    return {}
+        for (_, table_name), constraints in constraints_by_table.items()
+    }
 
 
 @task(name="Sync Table Columns", cache_key_fn=no_cache_key)
@@ -118,6 +161,7 @@ def sync_table_columns(
         column.name: column
         for column in table_class.__table__.columns
     }
+    quote = engine.dialect.identifier_preparer.quote
 
     try:
         with engine.connect() as conn:
@@ -132,8 +176,8 @@ def sync_table_columns(
                     )
 
                     conn.execute(text(
-                        f"ALTER TABLE {table_name} "
-                        f"ADD COLUMN {col_name} {column_type} "
+                        f"ALTER TABLE {quote(table_name)} "
+                        f"ADD COLUMN {quote(col_name)} {column_type} "
                         f"{nullable} {default}"
                     ))
                     logging.info(f"Added column {col_name} to {table_name}")
@@ -143,7 +187,8 @@ def sync_table_columns(
             ):
                 if not existing_columns[col_name].get('primary_key', False):
                     conn.execute(text(
-                        f"ALTER TABLE {table_name} DROP COLUMN {col_name}"
+                        f"ALTER TABLE {quote(table_name)} "
+                        f"DROP COLUMN {quote(col_name)}"
                     ))
                     logging.info(
                         f"Removed column {col_name} from {table_name}"
@@ -155,25 +200,136 @@ def sync_table_columns(
         raise
 
 
+def resolve_duplicate_rows(
+    conn,
+    table_class: Type[Base],
+    column_names: tuple,
+    remove_duplicates: bool
+) -> None:
+    """
+    Make sure no rows share the given columns before they become unique
+
+    Args:
+        conn: SQLAlchemy connection
+        table_class: SQLAlchemy model class
+        column_names: Columns that are about to become unique
+        remove_duplicates: Delete duplicates, keeping the highest id per
+            key, instead of failing
+    """
+    table_name = table_class.__tablename__
+    quote = conn.dialect.identifier_preparer.quote
+    primary_key = quote(
+        next(iter(table_class.__table__.primary_key.columns)).name
+    )
+    same_key = " AND ".join(
+        f"a.{quote(column)} = b.{quote(column)}" for column in column_names
+    )
+    duplicate_condition = f"a.{primary_key} < b.{primary_key} AND {same_key}"
+
+    duplicates = conn.execute(text(
+        f"SELECT count(*) FROM {quote(table_name)} AS a WHERE EXISTS ("
+        f"SELECT 1 FROM {quote(table_name)} AS b "
+        f"WHERE {duplicate_condition})"
+    )).scalar_one()
+    if not duplicates:
+        return
+
+    if not remove_duplicates:
+        raise ValueError(
+            f"{table_name} has {duplicates} rows that duplicate another row "
+            f"on {column_names}, so the unique constraint cannot be added. "
+            f"Remove them manually, or rerun the schema sync with "
+            f"remove_duplicates=True to keep only the highest id per key."
+        )
+
+    conn.execute(text(
+        f"DELETE FROM {quote(table_name)} AS a "
+        f"USING {quote(table_name)} AS b WHERE {duplicate_condition}"
+    ))
+    logging.warning(
+        f"Deleted {duplicates} duplicate rows on {column_names} "
+        f"from {table_name}, keeping the highest id per key"
+    )
+
+
+@task(name="Sync Table Constraints", cache_key_fn=no_cache_key)
+def sync_table_constraints(
+    engine: create_engine,
+    table_class: Type[Base],
+    existing_constraints: Set[tuple],
+    remove_duplicates: bool = False
+) -> None:
+    """
+    Add declared unique constraints missing from an existing table
+
+    Args:
+        engine: SQLAlchemy engine
+        table_class: SQLAlchemy model class
+        existing_constraints: Set of constrained column name tuples
+        remove_duplicates: Delete rows that would violate a new constraint
+    """
+    table_name = table_class.__tablename__
+
+    try:
+        with engine.connect() as conn:
+            for constraint in table_class.__table__.constraints:
+                if not isinstance(constraint, UniqueConstraint):
+                    continue
+
+                column_names = tuple(constraint.columns.keys())
+                if column_names not in existing_constraints:
+                    resolve_duplicate_rows(
+                        conn,
+                        table_class,
+                        column_names,
+                        remove_duplicates
+                    )
+                    conn.execute(AddConstraint(constraint))
+                    logging.info(
+                        f"Added unique constraint on {column_names} "
+                        f"to {table_name}"
+                    )
+
+            conn.commit()
+    except Exception as e:
+        logging.error(
+            f"Error syncing constraints for table {table_name}: {e}"
+        )
+        raise
+
+
 @task(name="Sync Single Table", cache_key_fn=no_cache_key)
-def sync_table_schema(engine: create_engine, table_class: Type[Base]) -> None:
+def sync_table_schema(
+    engine: create_engine,
+    table_class: Type[Base],
+    existing_columns: Dict,
+    existing_constraints: Set[tuple],
+    remove_duplicates: bool = False
+) -> None:
     """
     Synchronize schema for a single table
 
     Args:
         engine: SQLAlchemy engine
         table_class: SQLAlchemy model class
+        existing_columns: Dict of existing columns
+        existing_constraints: Set of constrained column name tuples
+        remove_duplicates: Delete rows that would violate a new constraint
     """
     table_name = table_class.__tablename__
 
     try:
-        existing_columns = get_existing_columns(engine, table_name)
-
         if not existing_columns:
             table_class.__table__.create(engine)
             logging.info(f"Created new table {table_name}")
         else:
             sync_table_columns(engine, table_class, existing_columns)
+            sync_table_constraints(
+                engine,
+                table_class,
+                existing_constraints,
+                remove_duplicates
+            )
 
     except Exception as e:
         logging.error(f"Error syncing table {table_name}: {e}")
@@ -184,7 +340,8 @@ def sync_table_schema(engine: create_engine, table_class: Type[Base]) -> None:
 def sync_database_schema(
     database_url: str,
     db_name: str = "data_app",
-    retries: int = 3
+    retries: int = 3,
+    remove_duplicates: bool = False
 ) -> None:
     """
     Main flow for synchronizing database schema
@@ -193,29 +350,40 @@ def sync_database_schema(
         database_url: Database connection URL
         db_name: Name of database to sync
         retries: Number of retries for the flow
+        remove_duplicates: Delete rows that would violate a newly added
+            unique constraint, keeping the highest id per key
     """
     logging.info(f"Starting schema sync for database {db_name}")
 
     initial_engine = create_engine_task(database_url)
 
-    try:
-        db_exists = check_database_exists(initial_engine, db_name)
-        if not db_exists:
-            create_database(initial_engine, db_name)
-    finally:
-        initial_engine.dispose()
+    db_exists = check_database_exists(initial_engine, db_name)
+    if not db_exists:
+        create_database(initial_engine, db_name)
 
     final_engine = create_engine_task(database_url, db_name)
 
     try:
-        for table_class in Base.__subclasses__():
-            sync_table_schema(final_engine, table_class)
+        table_names = [table_class.__tablename__ for table_class in TABLES]
+        existing_columns = get_existing_columns(final_engine, table_names)
+        existing_constraints = get_existing_unique_constraints(
+            final_engine,
+            table_names
+        )
+
+        for table_class in TABLES:
+            table_name = table_class.__tablename__
+            sync_table_schema(
+                final_engine,
+                table_class,
+                existing_columns.get(table_name, {}),
+                existing_constraints.get(table_name, set()),
+                remove_duplicates
+            )
         logging.info("Schema sync completed successfully")
     except Exception as e:
         logging.error(f"Schema sync failed: {e}")
         raise
-    finally:
-        final_engine.dispose()
 
 
 if __name__ == "__main__":
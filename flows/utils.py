@@ -1,10 +1,43 @@
+import atexit
+import os
 import re
+import threading
+from sqlalchemy import create_engine
+
+CAMEL_CASE_RE = re.compile(r'([a-z])([A-Z])')
+SQL_ECHO = os.getenv('SQL_ECHO') == '1'
+
+_engines = {}
+_engines_lock = threading.Lock()
 
 
 def camel_to_snake(camel_case_str):
-    return re.sub(r'([a-z])([A-Z])', r'\1_\2', camel_case_str).lower()
+    return CAMEL_CASE_RE.sub(r'\1_\2', camel_case_str).lower()
 
 
 def no_cache_key(*args, **kwargs):
     """Custom cache key function that disables caching"""
     return None
+
+
+def get_engine(url):
+    """Return a process-wide engine per URL so its pool outlives flow runs"""
+    with _engines_lock:
+        if url not in _engines:
+            _engines[url] = create_engine(
+                url,
+                echo=SQL_ECHO,
+                pool_size=10,
+                max_overflow=20,
+                pool_pre_ping=True
+            )
+        return _engines[url]
+
+
+@atexit.register
+def dispose_engines():
+    """Close the pooled connections of every cached engine"""
+    with _engines_lock:
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
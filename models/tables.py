@@ -1,9 +1,11 @@
 from sqlalchemy import (
+    BigInteger,
     Column,
     Integer,
     String,
     Float,
-    DateTime
+    DateTime,
+    UniqueConstraint
 )
 from sqlalchemy.orm import declarative_base
 
@@ -12,9 +14,12 @@ Base = declarative_base()
 
 class Order(Base):
     __tablename__ = "orders"
-    id = Column(Integer, primary_key=True, autoincrement=True)
-    order_id = Column(String)
-    product_id = Column(String)
+    __table_args__ = (
+        UniqueConstraint('order_id', 'product_id', 'date_time'),
+    )
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    order_id = Column(String, nullable=False)
+    product_id = Column(String, nullable=False)
     currency = Column(String, nullable=True)
     quantity = Column(Integer)
     shipping_cost = Column(Float, nullable=True)
@@ -22,14 +27,17 @@ class Order(Base):
     channel = Column(String, nullable=True)
     channel_group = Column(String, nullable=True)
     campaign = Column(String, nullable=True)
-    date_time = Column(DateTime)
+    date_time = Column(DateTime, nullable=False)
 
 
 class Inventory(Base):
     __tablename__ = "inventories"
-    id = Column(Integer, primary_key=True, autoincrement=True)
-    product_id = Column(String)
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    product_id = Column(String, unique=True, nullable=False)
     name = Column(String)
     quantity = Column(Integer)
     category = Column(String, nullable=True)
     sub_category = Column(String, nullable=True)
+
+
+TABLES = (Inventory, Order)